@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark.
+Measures how long the bot takes to import and build its client, and breaks
+the import time down by top-level module.
+
+Usage: python benchmark_startup.py [runs]
+"""
+
+import os
+import re
+import sys
+import tempfile
+import statistics
+import subprocess
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Calls each lazily importing utils function once, without waiting on the
+# network, and checks that the heavy dependencies were actually loaded
+FIRST_USE_CODE = """
+import sys
+import asyncio
+import tempfile
+from utils.image_handler import scrape_images
+from utils.pdf_generator import create_pdf_from_images
+from utils.anime_fetcher import fetch_anime_info
+
+scrape_images("http://127.0.0.1:9/")
+try:
+    create_pdf_from_images(tempfile.mkdtemp(), "unused.pdf")
+except Exception:
+    pass
+
+async def start_fetch():
+    # Let the coroutine run up to its first network wait, then stop it
+    task = asyncio.ensure_future(fetch_anime_info("benchmark"))
+    await asyncio.sleep(0)
+    task.cancel()
+
+asyncio.run(start_fetch())
+missing = [name for name in ("requests", "bs4", "PIL.Image", "aiohttp") if name not in sys.modules]
+assert not missing, f"not loaded on first use: {missing}"
+"""
+
+# Each stage runs in a fresh interpreter so nothing is already imported
+STAGES = [
+    ("import merged_bot", "import merged_bot"),
+    ("create_client()", "import merged_bot\nmerged_bot.create_client()"),
+    ("import worker", "import worker"),
+    ("first use of utils", FIRST_USE_CODE),
+]
+
+IMPORT_LINE = re.compile(r"import time:\s+(\d+) \|\s+\d+ \| *(\S+)")
+
+def run_python(code, *flags):
+    """Run code in a fresh interpreter from the project folder."""
+    # Keep the host limits learned from the benchmark's failed requests out of the project
+    env = dict(
+        os.environ,
+        WORKERS="0",
+        HOST_LIMITS_FILE=os.path.join(tempfile.gettempdir(), "benchmark_host_limits.json")
+    )
+    return subprocess.run(
+        [sys.executable, *flags, "-c", code],
+        cwd=PROJECT_DIR, env=env, capture_output=True, text=True
+    )
+
+def time_stage(code, runs):
+    """
+    Times a stage over several runs.
+
+    Args:
+        code (str): The code to time.
+        runs (int): Number of fresh interpreters to run it in.
+
+    Returns:
+        tuple: List of timings in seconds and an error message (if any).
+    """
+    timed = f"import time\n_t = time.perf_counter()\n{code}\nprint(time.perf_counter() - _t)"
+    timings = []
+    for _ in range(runs):
+        result = run_python(timed)
+        if result.returncode != 0:
+            lines = result.stderr.strip().splitlines()
+            return None, lines[-1] if lines else f"exit code {result.returncode}"
+        timings.append(float(result.stdout.strip().splitlines()[-1]))
+    return timings, None
+
+def import_breakdown(code, top=15):
+    """
+    Totals a stage's import time per top-level package using -X importtime.
+
+    Args:
+        code (str): The code to profile.
+        top (int): Number of packages to list.
+
+    Returns:
+        tuple: (package, seconds) pairs, slowest first, and an error message (if any).
+    """
+    result = run_python(code, "-X", "importtime")
+    if result.returncode != 0:
+        lines = result.stderr.strip().splitlines()
+        return None, lines[-1] if lines else f"exit code {result.returncode}"
+    packages = {}
+    for line in result.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            # Self time only, so nested imports aren't counted twice
+            package = match.group(2).split(".")[0]
+            packages[package] = packages.get(package, 0) + int(match.group(1)) / 1e6
+    return sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top], None
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    print(f"Startup times over {runs} runs:\n")
+    for name, code in STAGES:
+        timings, error = time_stage(code, runs)
+        if error:
+            print(f"  {name:<26} failed: {error}")
+            continue
+        print(
+            f"  {name:<26} median {statistics.median(timings) * 1000:8.1f} ms"
+            f"   min {min(timings) * 1000:8.1f} ms"
+        )
+
+    for name, code in (STAGES[0], STAGES[-1]):
+        print(f"\nImport time by package for {name}:\n")
+        packages, error = import_breakdown(code)
+        if error:
+            print(f"  failed: {error}")
+            continue
+        for package, seconds in packages:
+            print(f"  {package:<26} {seconds * 1000:8.1f} ms")
+
+if __name__ == "__main__":
+    main()
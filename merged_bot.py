@@ -4,22 +4,30 @@ Anime & Multporn Telegram Bot
 A multipurpose bot that handles anime information and multporn image downloads.
 """
 
+import time
+
+# Taken before anything else is imported, for the startup metrics
+STARTED_AT = time.monotonic()
+
 import os
 import re
+import sys
 import asyncio
 import logging
+import tempfile
+import subprocess
 from dotenv import load_dotenv
 
+# Load environment variables before the utils modules read their settings
+load_dotenv()
+
 # Import custom modules
 from utils.anime_fetcher import fetch_anime_info
 from utils.image_handler import scrape_images, download_images
 from utils.pdf_generator import create_pdf_from_images
 from utils.helpers import cleanup_temp_folder
-
-# Pyrogram imports
-from pyrogram import Client, filters
-from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from pyrogram.enums import ParseMode
+from utils.metrics import format_metrics, set_gauge
+from utils.job_queue import JobQueue
 
 # Set up logging
 logging.basicConfig(
@@ -28,8 +36,6 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Load environment variables
-load_dotenv()
 API_ID = int(os.getenv("API_ID", "0"))
 API_HASH = os.getenv("API_HASH", "")
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
@@ -37,14 +43,25 @@ BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 # Allowed Users - Add your user IDs here
 ALLOWED_USERS = set(os.getenv("ALLOWED_USERS", "").split(","))
 
-# Initialize the bot
-bot = Client("anime_multporn_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
+# Number of worker processes; 0 runs every job inside the bot process
+WORKERS = int(os.getenv("WORKERS", "0"))
+
+# Durable job queue shared with the worker processes (worker mode only)
+job_queue = JobQueue() if WORKERS > 0 else None
 
 # User session storage
 USER_SELECTION = {}
 
+# Worker mode: one delivery queue and task per chat, so a chat with large
+# uploads never holds up messages for the others
+DELIVERY_QUEUES = {}
+DELIVERY_TASKS = {}
+DELIVERY_ATTEMPTS = 5
+DELIVERY_IDLE_TIMEOUT = 60
+
+first_update_received = False
+
 # ========== BOT COMMANDS ==========
-@bot.on_message(filters.command("start"))
 async def start(client, message):
     """Handles the /start command."""
     if str(message.from_user.id) not in ALLOWED_USERS:
@@ -59,7 +76,6 @@ async def start(client, message):
         "• Use /split for Telegram links with episode numbering"
     )
 
-@bot.on_message(filters.command("anime"))
 async def anime_command(client, message):
     """Handles the /anime command."""
     if str(message.from_user.id) not in ALLOWED_USERS:
@@ -69,7 +85,6 @@ async def anime_command(client, message):
     await message.reply_text("📩 Send me the anime name:")
     USER_SELECTION[message.chat.id] = {"state": "waiting_anime_name"}
 
-@bot.on_message(filters.command("setparams"))
 async def set_params(client, message):
     """
     Sets the anime name parameter.
@@ -93,7 +108,6 @@ async def set_params(client, message):
         await message.reply_text("❌ Invalid usage. Use /setparams <anime_name with {episode}>\n"
                                "Example: /setparams [AW] S01-E{episode} Anime Name [1080p] [Dual]")
 
-@bot.on_message(filters.command("split"))
 async def split_command(client, message):
     """Initiates the link splitting process."""
     if str(message.from_user.id) not in ALLOWED_USERS:
@@ -107,7 +121,21 @@ async def split_command(client, message):
     USER_SELECTION[message.chat.id]['state'] = 'split_start'
     await message.reply_text("Send the start link (format: https://t.me/channel/message_id)")
 
-@bot.on_callback_query()
+async def metrics_command(client, message):
+    """Shows the bot's current metrics, including learned host limits."""
+    if str(message.from_user.id) not in ALLOWED_USERS:
+        await message.reply_text("🚫 You are not authorized to use this command.")
+        return
+    
+    worker_records = []
+    if job_queue:
+        for status, count in (await asyncio.to_thread(job_queue.stats)).items():
+            set_gauge("jobs", count, status=status)
+        # Downloads run in the workers, so their host metrics live there
+        worker_records = await asyncio.to_thread(job_queue.worker_metrics)
+    
+    await message.reply_text(format_metrics(worker_records) or "No metrics recorded yet.")
+
 async def button_callback(client, callback_query):
     """Handles button callbacks from inline keyboards."""
     chat_id = callback_query.message.chat.id
@@ -122,6 +150,8 @@ async def button_callback(client, callback_query):
         await callback_query.answer("❌ No active selection found.")
         return
 
+    from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
     # Handle quality selection
     if data in ["480p", "720p", "1080p", "720p_1080p", "480p_720p_1080p"]:
         USER_SELECTION[chat_id]["quality"] = data.replace("_", ", ")
@@ -141,26 +171,24 @@ async def button_callback(client, callback_query):
         quality = USER_SELECTION[chat_id]["quality"]
         format_type = data
         
-        # Get anime info from AniList
-        anime = await fetch_anime_info(anime_name)
-        if not anime:
-            await callback_query.message.reply_text("❌ Anime not found.")
+        if job_queue:
+            job_id = await asyncio.to_thread(job_queue.enqueue, "anime", chat_id, {
+                "anime_name": anime_name,
+                "format_type": format_type,
+                "quality": quality
+            })
+            USER_SELECTION.pop(chat_id, None)
+            position = await asyncio.to_thread(job_queue.position, job_id)
+            await callback_query.answer(f"⏳ Queued (position {position})")
+            return
+        
+        if not await process_anime_request(client, callback_query.message, anime_name, format_type, quality):
             return
-
-        # Format the response based on template selected
-        await send_formatted_anime_response(
-            client, 
-            callback_query.message, 
-            anime, 
-            format_type, 
-            quality
-        )
         
         # Clear user selection
         USER_SELECTION.pop(chat_id, None)
         await callback_query.answer("✅ Anime info sent!")
 
-@bot.on_message(filters.text & (filters.private | filters.group))
 async def handle_text(client, message):
     """Handles text messages in private chats and groups."""
     chat_id = message.chat.id
@@ -170,6 +198,8 @@ async def handle_text(client, message):
         await message.reply_text("🚫 You are not authorized to use this bot.")
         return
 
+    from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
     text = message.text.strip()
     current_state = USER_SELECTION.get(chat_id, {}).get("state")
 
@@ -237,8 +267,17 @@ async def handle_text(client, message):
             await message.reply_text("❌ Please send a valid number.")
             return
             
+        url = USER_SELECTION[chat_id]["url"]
+        USER_SELECTION.pop(chat_id, None)
+        
+        if job_queue:
+            job_id = await asyncio.to_thread(job_queue.enqueue, "multporn", chat_id, {"url": url, "limit": limit})
+            position = await asyncio.to_thread(job_queue.position, job_id)
+            await message.reply_text(f"⏳ Queued (position {position})")
+            return
+        
         # Process multporn download
-        await process_multporn_download(client, message, limit)
+        await process_multporn_download(client, message, url, limit)
         return
 
 async def process_split_links(client, message, start_link, end_link, anime_name):
@@ -272,59 +311,70 @@ async def process_split_links(client, message, start_link, end_link, anime_name)
         chunk = links[i:i + 30]
         await message.reply_text("\n".join(chunk))
 
-async def process_multporn_download(client, message, limit):
+async def process_anime_request(client, message, anime_name, format_type, quality):
+    """Fetch anime info and send it in the selected format. Returns False if not found."""
+    # Get anime info from AniList
+    anime = await fetch_anime_info(anime_name)
+    if not anime:
+        await message.reply_text("❌ Anime not found.")
+        return False
+
+    # Format the response based on template selected
+    await send_formatted_anime_response(client, message, anime, format_type, quality)
+    return True
+
+async def process_multporn_download(client, message, url, limit):
     """Process multporn link and download images."""
     chat_id = message.chat.id
-    url = USER_SELECTION[chat_id]["url"]
     
     await message.reply_text("🔍 Fetching images, please wait...")
     
     # Scrape images from the URL
-    image_urls, error = scrape_images(url)
+    image_urls, error = await asyncio.to_thread(scrape_images, url)
     if error:
         await message.reply_text(f"❌ Error: {error}")
-        USER_SELECTION.pop(chat_id, None)
         return
         
     # Select limited number of images
     selected_images = image_urls[:limit]
     if not selected_images:
         await message.reply_text("❌ No images found.")
-        USER_SELECTION.pop(chat_id, None)
         return
         
-    # Create temp folder for downloading
-    temp_folder = f"temp_downloads_{chat_id}"
-    os.makedirs(temp_folder, exist_ok=True)
+    # Create temp folder for downloading, unique per job so parallel jobs don't collide
+    temp_folder = tempfile.mkdtemp(prefix=f"temp_downloads_{chat_id}_", dir=".")
+    
+    try:
+        # Download images
+        await message.reply_text(f"⬇️ Downloading {len(selected_images)} images...")
+        downloaded_paths = await download_images(selected_images, temp_folder)
     
-    # Download images
-    await message.reply_text(f"⬇️ Downloading {len(selected_images)} images...")
-    downloaded_paths = await download_images(selected_images, temp_folder)
+        # Send images to user
+        for path in downloaded_paths:
+            try:
+                await client.send_document(chat_id, path)
+            except Exception as e:
+                logger.error(f"Error sending document: {e}")
     
-    # Send images to user
-    for path in downloaded_paths:
+        # Create and send PDF
+        await message.reply_text("📄 Generating PDF...")
         try:
-            await client.send_document(chat_id, path)
+            pdf_path = os.path.join(temp_folder, "output.pdf")
+            # Pillow encoding is CPU-bound; keep it off the event loop
+            await asyncio.to_thread(create_pdf_from_images, temp_folder, pdf_path)
+            await client.send_document(chat_id, pdf_path, file_name="multporn_images.pdf")
+            await message.reply_text("✅ All images and PDF have been sent!")
         except Exception as e:
-            logger.error(f"Error sending document: {e}")
-    
-    # Create and send PDF
-    await message.reply_text("📄 Generating PDF...")
-    try:
-        pdf_path = os.path.join(temp_folder, "output.pdf")
-        create_pdf_from_images(temp_folder, pdf_path)
-        await client.send_document(chat_id, pdf_path, file_name="multporn_images.pdf")
-        await message.reply_text("✅ All images and PDF have been sent!")
-    except Exception as e:
-        logger.error(f"Error creating PDF: {e}")
-        await message.reply_text(f"❌ Error creating PDF: {str(e)}")
-    
-    # Clean up
-    USER_SELECTION.pop(chat_id, None)
-    cleanup_temp_folder(temp_folder)
+            logger.error(f"Error creating PDF: {e}")
+            await message.reply_text(f"❌ Error creating PDF: {str(e)}")
+    finally:
+        # Also runs if the job is cancelled or a send fails
+        cleanup_temp_folder(temp_folder)
 
 async def send_formatted_anime_response(client, message, anime, format_type, quality):
     """Send formatted anime response based on template."""
+    from pyrogram.enums import ParseMode
+
     if not anime:
         await message.reply_text("❌ Anime not found.")
         return
@@ -385,7 +435,174 @@ Report Missing Episodes: @Otaku_Library_Support_Bot"""
             parse_mode=ParseMode.HTML
         )
 
+# ========== WORKER MODE ==========
+def remove_outbox_file(path):
+    """Delete a delivered worker file and its job folder once empty."""
+    try:
+        os.remove(path)
+        os.rmdir(os.path.dirname(path))
+    except OSError:
+        pass
+
+async def deliver_event(client, chat_id, event):
+    """Send one message posted by a worker."""
+    from pyrogram.enums import ParseMode
+
+    parse_mode = ParseMode[event["parse_mode"]] if event.get("parse_mode") else None
+    
+    if event["type"] == "text":
+        await client.send_message(chat_id, event["text"], parse_mode=parse_mode)
+    elif event["type"] == "document":
+        await client.send_document(chat_id, event["path"], file_name=event.get("file_name"))
+        remove_outbox_file(event["path"])
+    elif event["type"] == "photo":
+        try:
+            await client.send_photo(chat_id, photo=event["photo"], caption=event["caption"], parse_mode=parse_mode)
+        except Exception as e:
+            logger.error(f"Error sending photo: {e}")
+            # Fallback to text-only if image fails
+            await client.send_message(
+                chat_id,
+                f"⚠️ Could not load image, but here's the info:\n\n{event['caption']}",
+                parse_mode=parse_mode
+            )
+
+async def deliver_chat_events(client, chat_id, queue):
+    """Send a chat's messages in the order they were posted, retrying failed sends."""
+    from pyrogram.errors import FloodWait
+
+    try:
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), DELIVERY_IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                if not queue.empty():
+                    continue
+                # Nothing else runs between the check and the cleanup below, so no event can be lost
+                return
+                
+            delivered = False
+            for attempt in range(1, DELIVERY_ATTEMPTS + 1):
+                try:
+                    await deliver_event(client, chat_id, event["payload"])
+                    delivered = True
+                    break
+                except FloodWait as e:
+                    delay = e.value
+                except Exception as e:
+                    delay = min(2 ** attempt, 60)
+                    logger.error(f"Error delivering event {event['id']} to chat {chat_id} (attempt {attempt}): {e}")
+                if attempt < DELIVERY_ATTEMPTS:
+                    await asyncio.sleep(delay)
+            
+            # Kept apart from the sends so a database error never sends a message twice
+            try:
+                if delivered:
+                    await asyncio.to_thread(job_queue.mark_delivered, [event["id"]])
+                else:
+                    logger.error(f"Giving up on event {event['id']} for chat {chat_id}")
+                    await asyncio.to_thread(job_queue.drop_event, event["id"])
+                    if event["payload"]["type"] == "document":
+                        remove_outbox_file(event["payload"]["path"])
+            except Exception as e:
+                logger.error(f"Error recording delivery of event {event['id']}: {e}")
+    finally:
+        # Let deliver_events start a new task for the chat, even if this one failed
+        DELIVERY_QUEUES.pop(chat_id, None)
+        DELIVERY_TASKS.pop(chat_id, None)
+
+async def deliver_events(client):
+    """Relay worker progress and results to Telegram, each chat on its own task."""
+    last_id = 0
+    while True:
+        events = await asyncio.to_thread(job_queue.pending_events, last_id)
+        if not events:
+            await asyncio.sleep(0.5)
+            continue
+            
+        for event in events:
+            last_id = event["id"]
+            chat_id = event["chat_id"]
+            if chat_id not in DELIVERY_QUEUES:
+                DELIVERY_QUEUES[chat_id] = asyncio.Queue()
+                DELIVERY_TASKS[chat_id] = asyncio.create_task(
+                    deliver_chat_events(client, chat_id, DELIVERY_QUEUES[chat_id])
+                )
+            DELIVERY_QUEUES[chat_id].put_nowait(event)
+
+def start_worker(name):
+    """Start a worker process running the job pipelines."""
+    logger.info(f"Starting {name}")
+    worker_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "worker.py")
+    return subprocess.Popen([sys.executable, worker_script, name])
+
+async def supervise_workers(workers):
+    """Restart worker processes that exit. Their jobs return to the queue."""
+    while True:
+        await asyncio.sleep(5)
+        for name, process in workers.items():
+            if process.poll() is not None:
+                logger.warning(f"{name} exited with code {process.returncode}, restarting")
+                workers[name] = start_worker(name)
+
+# ========== STARTUP ==========
+async def record_first_update(client, update, users, chats):
+    """Report how long after launch the first update arrived."""
+    global first_update_received
+    if first_update_received:
+        return
+        
+    first_update_received = True
+    elapsed = time.monotonic() - STARTED_AT
+    set_gauge("time_to_first_update_seconds", elapsed)
+    logger.info(f"First update received {elapsed:.2f}s after launch")
+
+def create_client():
+    """Build the Pyrogram client and register the bot's handlers."""
+    from pyrogram import Client, filters
+    from pyrogram.handlers import MessageHandler, CallbackQueryHandler, RawUpdateHandler
+    
+    client = Client("anime_multporn_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
+    
+    # Runs ahead of the regular handlers and lets every update through
+    client.add_handler(RawUpdateHandler(record_first_update), group=-1)
+    
+    client.add_handler(MessageHandler(start, filters.command("start")))
+    client.add_handler(MessageHandler(anime_command, filters.command("anime")))
+    client.add_handler(MessageHandler(set_params, filters.command("setparams")))
+    client.add_handler(MessageHandler(split_command, filters.command("split")))
+    client.add_handler(MessageHandler(metrics_command, filters.command("metrics")))
+    client.add_handler(CallbackQueryHandler(button_callback))
+    client.add_handler(MessageHandler(handle_text, filters.text & (filters.private | filters.group)))
+    return client
+
+async def run_bot(client):
+    """Run the bot until stopped, as a thin front end for the workers in worker mode."""
+    from pyrogram import idle
+    
+    workers = {f"worker-{i}": start_worker(f"worker-{i}") for i in range(1, WORKERS + 1)}
+    
+    await client.start()
+    elapsed = time.monotonic() - STARTED_AT
+    set_gauge("startup_seconds", elapsed)
+    logger.info(f"Client started {elapsed:.2f}s after launch")
+    
+    tasks = []
+    if job_queue:
+        tasks = [asyncio.create_task(deliver_events(client)), asyncio.create_task(supervise_workers(workers))]
+        print(f"✅ Bot is running with {WORKERS} workers...")
+    else:
+        print("✅ Bot is running...")
+    try:
+        await idle()
+    finally:
+        for task in tasks + list(DELIVERY_TASKS.values()):
+            task.cancel()
+        for process in workers.values():
+            process.terminate()
+        await client.stop()
+
 # Main execution
 if __name__ == "__main__":
-    print("✅ Bot is running...")
-    bot.run()
+    bot = create_client()
+    bot.run(run_bot(bot))
@@ -5,7 +5,6 @@ Fetches anime information from AniList GraphQL API.
 """
 
 import logging
-import aiohttp
 
 logger = logging.getLogger(__name__)
 
@@ -19,6 +18,9 @@ async def fetch_anime_info(anime_name):
     Returns:
         dict: Anime details from AniList API or None if not found.
     """
+    # Imported on first use to keep startup fast
+    import aiohttp
+
     url = "https://graphql.anilist.co/"
     query = """
     query ($search: String) {
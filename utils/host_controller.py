@@ -0,0 +1,596 @@
+#!/usr/bin/env python3
+"""
+Host controller module.
+Adapts per-host concurrency and request rate for upstream image hosts.
+
+Concurrency grows additively while a host answers quickly and is cut
+multiplicatively on throttling (429/503), network errors or rising latency.
+Learned limits are saved to disk so they survive restarts. In worker mode
+the worker processes share one set of limits through the job database and
+split each host's window between the processes using it.
+"""
+
+import os
+import json
+import time
+import fcntl
+import atexit
+import sqlite3
+import logging
+import asyncio
+import threading
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+MIN_CONCURRENCY = 1.0
+MAX_CONCURRENCY = 16.0
+INITIAL_CONCURRENCY = 2.0
+BACKOFF_FACTOR = 0.5
+
+MIN_INTERVAL = 0.0
+MAX_INTERVAL = 10.0
+INITIAL_INTERVAL = 0.5
+INTERVAL_STEP = 0.05
+
+# Smoothed latency counts as congestion only when it is both this multiple of
+# the baseline and at least MIN_EXCESS_LATENCY seconds above it
+LATENCY_TOLERANCE = 3.0
+MIN_EXCESS_LATENCY = 0.5
+LATENCY_SMOOTHING = 0.2
+# The baseline follows new minimums at once and drifts up towards slower
+# responses, so one fast or cached response doesn't set it for good
+BASELINE_DRIFT = 0.01
+MIN_LATENCY_SAMPLES = 5
+# Never back off more than once per this many seconds
+DECREASE_COOLDOWN = 1.0
+MAX_RETRY_AFTER = 300.0
+SAVE_INTERVAL = 30.0
+SLOT_POLL_INTERVAL = 0.05
+# How often each process merges its changes into the shared limits
+SYNC_INTERVAL = 1.0
+# A process counts as using a host if it reported within ACTIVE_WINDOW seconds,
+# or still has requests in flight and reported within STALE_USAGE seconds
+ACTIVE_WINDOW = 5.0
+STALE_USAGE = 120.0
+
+THROTTLE_STATUSES = (429, 503)
+
+SHARED_SCHEMA = """
+CREATE TABLE IF NOT EXISTS host_limits (
+    host TEXT PRIMARY KEY,
+    concurrency REAL NOT NULL,
+    interval REAL NOT NULL,
+    base_latency REAL,
+    last_decrease REAL NOT NULL DEFAULT 0,
+    blocked_until REAL NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS host_usage (
+    host TEXT NOT NULL,
+    process TEXT NOT NULL,
+    in_flight INTEGER NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (host, process)
+);
+"""
+
+def parse_retry_after(value):
+    """
+    Parses a Retry-After header value.
+
+    Args:
+        value (str): Either a number of seconds or an HTTP date.
+
+    Returns:
+        float: Seconds to wait, or None if the value is missing or invalid.
+    """
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0.0), MAX_RETRY_AFTER)
+
+class HostState:
+    """Learned limits and live counters for a single host."""
+
+    def __init__(self, concurrency=INITIAL_CONCURRENCY, interval=INITIAL_INTERVAL):
+        self.concurrency = concurrency
+        self.interval = interval
+        self.in_flight = 0
+        self.next_allowed = 0.0
+        self.blocked_until = 0.0
+        self.last_decrease = 0.0
+        self.latency = None
+        self.base_latency = None
+        self.samples = 0
+        # Shared mode only: processes using the host, and changes not yet
+        # merged into the shared limits
+        self.share = 1
+        self.pending_increase = 0.0
+        self.pending_interval = 0.0
+        self.pending_decrease = None
+        self.last_sync = 0.0
+        self.syncing = False
+
+class SharedLimits:
+    """
+    Host limits stored in a SQLite database shared by several processes.
+
+    Processes merge their changes in as increments rather than overwriting
+    each other, back off at most once per cooldown between them, and report
+    which hosts they are using so a host's window can be split between them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.process = f"{os.uname().nodename}:{os.getpid()}"
+        self.ready = False
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            # Created on first use so importing the controller stays cheap
+            if not self.ready:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(SHARED_SCHEMA)
+                self.ready = True
+            yield conn
+        finally:
+            conn.close()
+
+    def sync(self, host, in_flight, increase=0.0, interval_decrease=0.0, cooldown=None,
+             blocked_until=0.0, base_latency=None):
+        """
+        Merges one process's changes into a host's shared limits and reads them back.
+
+        Args:
+            host (str): The host.
+            in_flight (int): Requests this process has in flight to the host.
+            increase (float): Concurrency gained since the last sync.
+            interval_decrease (float): Seconds taken off the interval since the last sync.
+            cooldown (float): If set, back off unless another process already
+                did within this many seconds. Pending increases are dropped.
+            blocked_until (float): Unix time before which the host asked not to be called.
+            base_latency (float): This process's latency baseline, if it has one.
+
+        Returns:
+            dict: The shared concurrency, interval, blocked_until and base_latency,
+            and the number of processes using the host.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "INSERT OR IGNORE INTO host_limits (host, concurrency, interval, updated_at) VALUES (?, ?, ?, ?)",
+                    (host, INITIAL_CONCURRENCY, INITIAL_INTERVAL, now)
+                )
+                if cooldown is not None:
+                    conn.execute(
+                        "UPDATE host_limits SET concurrency = MAX(concurrency * ?, ?), "
+                        "interval = MIN(MAX(interval * 2, ?), ?), last_decrease = ? "
+                        "WHERE host = ? AND last_decrease <= ?",
+                        (BACKOFF_FACTOR, MIN_CONCURRENCY, INTERVAL_STEP, MAX_INTERVAL, now, host, now - cooldown)
+                    )
+                elif increase or interval_decrease:
+                    conn.execute(
+                        "UPDATE host_limits SET concurrency = MIN(concurrency + ?, ?), "
+                        "interval = MAX(interval - ?, ?) WHERE host = ?",
+                        (increase, MAX_CONCURRENCY, interval_decrease, MIN_INTERVAL, host)
+                    )
+                conn.execute(
+                    "UPDATE host_limits SET blocked_until = MAX(blocked_until, ?), "
+                    "base_latency = COALESCE(?, base_latency), updated_at = ? WHERE host = ?",
+                    (blocked_until, base_latency, now, host)
+                )
+                conn.execute(
+                    "INSERT OR REPLACE INTO host_usage (host, process, in_flight, updated_at) VALUES (?, ?, ?, ?)",
+                    (host, self.process, in_flight, now)
+                )
+                conn.execute("DELETE FROM host_usage WHERE updated_at < ?", (now - STALE_USAGE,))
+                row = conn.execute(
+                    "SELECT concurrency, interval, blocked_until, base_latency FROM host_limits WHERE host = ?",
+                    (host,)
+                ).fetchone()
+                processes = conn.execute(
+                    "SELECT COUNT(*) FROM host_usage WHERE host = ? AND (updated_at >= ? OR in_flight > 0)",
+                    (host, now - ACTIVE_WINDOW)
+                ).fetchone()[0]
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return {
+            "concurrency": row[0],
+            "interval": row[1],
+            "blocked_until": row[2],
+            "base_latency": row[3],
+            "processes": max(processes, 1),
+        }
+
+class RequestSlot:
+    """
+    A single granted request against a host.
+
+    Call `record` with the response status once headers arrive, before
+    reading the body, so every caller measures latency the same way.
+    Leaving the `with` block without recording counts the request as a
+    network error.
+    """
+
+    def __init__(self, controller, host):
+        self.controller = controller
+        self.host = host
+        self.started = time.monotonic()
+        self.entered = False
+        self.recorded = False
+        self.released = False
+        # Whether the host's limits were actually binding for this request;
+        # limits are only raised when they were
+        self.window_full = False
+        self.spaced = False
+
+    def record(self, status, retry_after=None):
+        """
+        Reports the outcome of the request.
+
+        Args:
+            status (int): The HTTP status code.
+            retry_after (str): The raw Retry-After header, if any.
+        """
+        if self.recorded:
+            return
+        self.recorded = True
+        latency = time.monotonic() - self.started
+        self.controller._on_result(self, status, latency, parse_retry_after(retry_after))
+
+    def release(self):
+        """Gives the slot back. Safe to call more than once."""
+        with self.controller.condition:
+            if self.released:
+                return
+            self.released = True
+        self.controller._release(self.host)
+
+    def __enter__(self):
+        self.entered = True
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not self.recorded:
+            self.record(None)
+        self.release()
+        return False
+
+class HostController:
+    """
+    Per-host AIMD controller for concurrency and request spacing.
+
+    Thread-safe. Blocking code waits for capacity in `slot`; coroutines wait
+    in `async_slot` and then hand the request itself to a thread.
+    """
+
+    def __init__(self, limits_file=None, shared_db=None):
+        self.limits_file = limits_file or os.getenv("HOST_LIMITS_FILE", "host_limits.json")
+        workers = int(os.getenv("WORKERS", "0"))
+        # In worker mode the worker processes share their limits through the job database
+        if shared_db is None and workers > 0:
+            shared_db = os.getenv("JOB_DB", "jobs.db")
+        self.shared = SharedLimits(shared_db) if shared_db else None
+        # Until a host's first sync, assume every worker is using it
+        self.initial_share = max(workers, 1) if self.shared else 1
+        self.hosts = {}
+        self.condition = threading.Condition()
+        self.last_save = 0.0
+        # Hosts whose limits changed since the last save
+        self.dirty = set()
+        if not self.shared:
+            self._load()
+
+    def slot(self, url):
+        """
+        Waits until a request to the URL's host is allowed.
+
+        Args:
+            url (str): The URL about to be fetched.
+
+        Returns:
+            RequestSlot: Context manager holding the granted slot.
+        """
+        slot = RequestSlot(self, urlparse(url).netloc.lower())
+        with self.condition:
+            while True:
+                wait = self._try_acquire(slot)
+                if wait == 0:
+                    break
+                self.condition.wait(wait)
+        metrics.increment("host_requests_total", host=slot.host)
+        return slot
+
+    async def async_slot(self, url):
+        """
+        Waits without blocking the event loop until a request to the URL's host is allowed.
+
+        Args:
+            url (str): The URL about to be fetched.
+
+        Returns:
+            RequestSlot: Context manager holding the granted slot.
+        """
+        slot = RequestSlot(self, urlparse(url).netloc.lower())
+        while True:
+            with self.condition:
+                wait = self._try_acquire(slot)
+            if wait == 0:
+                break
+            await asyncio.sleep(min(wait or SLOT_POLL_INTERVAL, SLOT_POLL_INTERVAL * 10))
+        metrics.increment("host_requests_total", host=slot.host)
+        return slot
+
+    def snapshot(self):
+        """
+        Returns the current limits for every known host.
+
+        Returns:
+            dict: Mapping of host to its concurrency, interval and in-flight count.
+        """
+        with self.condition:
+            return {
+                host: {
+                    "concurrency": round(state.concurrency, 2),
+                    "interval": round(state.interval, 3),
+                    "in_flight": state.in_flight,
+                }
+                for host, state in self.hosts.items()
+            }
+
+    def flush(self):
+        """Saves the learned limits if they changed since the last save."""
+        # Shared limits are already stored in the database
+        if self.dirty and not self.shared:
+            self.save()
+
+    def save(self):
+        """
+        Writes the learned limits to the limits file.
+
+        Other processes may share the file, so only hosts that changed here
+        are written over; the rest of the file is kept as it is.
+        """
+        with self.condition:
+            changed = {
+                host: {
+                    "concurrency": state.concurrency,
+                    "interval": state.interval,
+                    "base_latency": state.base_latency,
+                }
+                for host, state in self.hosts.items()
+                if host in self.dirty
+            }
+            self.dirty = set()
+            self.last_save = time.monotonic()
+        try:
+            with open(f"{self.limits_file}.lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                data = {}
+                if os.path.exists(self.limits_file):
+                    try:
+                        with open(self.limits_file) as file:
+                            data = json.load(file)
+                    except ValueError as e:
+                        logger.error(f"Replacing unreadable host limits file {self.limits_file}: {e}")
+                data.update(changed)
+                tmp_path = f"{self.limits_file}.{os.getpid()}.tmp"
+                with open(tmp_path, "w") as file:
+                    json.dump(data, file, indent=2)
+                os.replace(tmp_path, self.limits_file)
+        except OSError as e:
+            logger.error(f"Error saving host limits to {self.limits_file}: {e}")
+
+    def _load(self):
+        if not os.path.exists(self.limits_file):
+            return
+        try:
+            with open(self.limits_file) as file:
+                data = json.load(file)
+            for host, limits in data.items():
+                concurrency = min(max(float(limits["concurrency"]), MIN_CONCURRENCY), MAX_CONCURRENCY)
+                interval = min(max(float(limits["interval"]), MIN_INTERVAL), MAX_INTERVAL)
+                self.hosts[host] = HostState(concurrency, interval)
+                self.hosts[host].base_latency = limits.get("base_latency")
+                self._publish(host, self.hosts[host])
+            logger.info(f"Loaded learned limits for {len(self.hosts)} hosts from {self.limits_file}")
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.error(f"Error loading host limits from {self.limits_file}: {e}")
+
+    def _try_acquire(self, slot):
+        """
+        Grants the slot if the host allows it. Must be called with the condition held.
+
+        Returns:
+            float: 0 if the slot was granted, otherwise seconds until the host is
+            ready, or None if it is waiting for a request to finish.
+        """
+        state = self._state(slot.host)
+        now = time.monotonic()
+        if now < state.blocked_until:
+            return state.blocked_until - now
+        if now < state.next_allowed:
+            slot.spaced = True
+            return state.next_allowed - now
+        # Each process using the host gets an equal part of its window
+        limit = max(int(state.concurrency / state.share), 1)
+        if state.in_flight >= limit:
+            return None
+        state.in_flight += 1
+        state.next_allowed = now + state.interval * state.share
+        slot.window_full = state.in_flight >= limit
+        return 0
+
+    def _state(self, host):
+        if host not in self.hosts:
+            self.hosts[host] = HostState()
+            self.hosts[host].share = self.initial_share
+            self._publish(host, self.hosts[host])
+        return self.hosts[host]
+
+    def _release(self, host):
+        with self.condition:
+            state = self.hosts[host]
+            state.in_flight -= 1
+            self.condition.notify_all()
+            # Tell the other processes straight away when this one goes idle
+            update = self._take_sync(host, state, force=state.in_flight == 0)
+        if update:
+            self._sync(host, update)
+        if time.monotonic() - self.last_save >= SAVE_INTERVAL:
+            self.flush()
+
+    def _take_sync(self, host, state, force=False):
+        """
+        Collects a host's pending changes if a sync is due. Must be called
+        with the condition held.
+
+        Returns:
+            dict: Arguments for SharedLimits.sync, or None if no sync is due.
+        """
+        if not self.shared or state.syncing:
+            return None
+        now = time.monotonic()
+        if not (force or state.pending_decrease is not None or now - state.last_sync >= SYNC_INTERVAL):
+            return None
+        update = {
+            "in_flight": state.in_flight,
+            "increase": state.pending_increase,
+            "interval_decrease": state.pending_interval,
+            "cooldown": state.pending_decrease,
+            "blocked_until": time.time() + state.blocked_until - now if state.blocked_until > now else 0.0,
+            "base_latency": state.base_latency,
+        }
+        state.pending_increase = 0.0
+        state.pending_interval = 0.0
+        state.pending_decrease = None
+        state.last_sync = now
+        state.syncing = True
+        return update
+
+    def _sync(self, host, update):
+        try:
+            shared = self.shared.sync(host, **update)
+        except sqlite3.Error as e:
+            logger.error(f"Error syncing shared limits for {host}: {e}")
+            shared = None
+        with self.condition:
+            state = self.hosts[host]
+            state.syncing = False
+            if shared is None:
+                return
+            state.concurrency = shared["concurrency"]
+            state.interval = shared["interval"]
+            state.share = shared["processes"]
+            if shared["blocked_until"] > time.time():
+                state.blocked_until = max(
+                    state.blocked_until, time.monotonic() + shared["blocked_until"] - time.time()
+                )
+            if state.base_latency is None:
+                state.base_latency = shared["base_latency"]
+            self._publish(host, state)
+            self.condition.notify_all()
+
+    def _on_result(self, slot, status, latency, retry_after):
+        host = slot.host
+        with self.condition:
+            state = self.hosts[host]
+            now = time.monotonic()
+
+            if status in THROTTLE_STATUSES:
+                outcome = "throttled"
+            elif status is None or status >= 500:
+                outcome = "error"
+            else:
+                outcome = "ok"
+                state.samples += 1
+                state.latency = latency if state.latency is None else (
+                    LATENCY_SMOOTHING * latency + (1 - LATENCY_SMOOTHING) * state.latency
+                )
+                if state.base_latency is None or latency < state.base_latency:
+                    state.base_latency = latency
+                else:
+                    state.base_latency += (latency - state.base_latency) * BASELINE_DRIFT
+
+            if retry_after:
+                state.blocked_until = max(state.blocked_until, now + retry_after)
+                logger.warning(f"{host} asked to retry after {retry_after:.1f}s")
+
+            congested = (
+                outcome == "ok"
+                and state.samples >= MIN_LATENCY_SAMPLES
+                and state.latency > state.base_latency * LATENCY_TOLERANCE
+                and state.latency - state.base_latency >= MIN_EXCESS_LATENCY
+            )
+            if outcome != "ok" or congested:
+                # Only back off once per round trip so a burst of failures from
+                # requests already in flight doesn't collapse the limits
+                if now - state.last_decrease >= max(state.latency or 0.0, DECREASE_COOLDOWN):
+                    reason = f"status {status}" if status else "network error"
+                    if congested:
+                        reason = f"latency {state.latency:.2f}s"
+                    self._decrease(host, state, reason)
+                    state.last_decrease = now
+                    state.pending_decrease = max(state.latency or 0.0, DECREASE_COOLDOWN)
+            elif status is not None and status < 400:
+                self._increase(host, state, slot.window_full, slot.spaced)
+
+            self._publish(host, state)
+            self.condition.notify_all()
+            update = self._take_sync(host, state, force=bool(retry_after))
+        if update:
+            self._sync(host, update)
+        metrics.increment("host_responses_total", host=host, outcome=outcome)
+
+    def _increase(self, host, state, window_full, spaced):
+        # Only loosen a limit the request actually ran into; an idle host
+        # would otherwise climb to limits that were never tested
+        old = state.concurrency
+        old_interval = state.interval
+        if window_full:
+            state.concurrency = min(state.concurrency + 1.0 / state.concurrency, MAX_CONCURRENCY)
+        if spaced:
+            state.interval = max(state.interval - INTERVAL_STEP, MIN_INTERVAL)
+        if state.concurrency != old or state.interval != old_interval:
+            self.dirty.add(host)
+            state.pending_increase += state.concurrency - old
+            state.pending_interval += old_interval - state.interval
+        if int(state.concurrency) > int(old):
+            logger.info(f"{host}: concurrency raised to {int(state.concurrency)}, interval {state.interval:.2f}s")
+            metrics.increment("host_limit_changes_total", host=host, direction="up")
+
+    def _decrease(self, host, state, reason):
+        old = state.concurrency
+        state.concurrency = max(state.concurrency * BACKOFF_FACTOR, MIN_CONCURRENCY)
+        state.interval = min(max(state.interval * 2, INTERVAL_STEP), MAX_INTERVAL)
+        logger.warning(
+            f"{host}: {reason}, concurrency {old:.1f} -> {state.concurrency:.1f}, "
+            f"interval {state.interval:.2f}s"
+        )
+        metrics.increment("host_limit_changes_total", host=host, direction="down")
+        self.dirty.add(host)
+
+    def _publish(self, host, state):
+        metrics.set_gauge("host_concurrency", state.concurrency, host=host)
+        metrics.set_gauge("host_interval_seconds", state.interval, host=host)
+
+host_controller = HostController()
+atexit.register(host_controller.flush)
@@ -6,13 +6,22 @@ Handles image scraping and downloading from multporn.net.
 
 import os
 import logging
-import requests
 import tempfile
 import asyncio
-from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.host_controller import host_controller, MAX_CONCURRENCY, THROTTLE_STATUSES
 
 logger = logging.getLogger(__name__)
 
+# Attempts per image when the host answers 429/503
+MAX_ATTEMPTS = 3
+
+# Threads for download_images, kept apart from the event loop's default
+# executor. Slots are taken before a download is handed over, so these
+# threads only ever run requests the host controller has allowed.
+_download_executor = ThreadPoolExecutor(max_workers=int(MAX_CONCURRENCY), thread_name_prefix="download")
+
 def scrape_images(url):
     """
     Scrapes image URLs from a given URL.
@@ -23,16 +32,23 @@ def scrape_images(url):
     Returns:
         tuple: A tuple containing a list of image URLs and an error message (if any).
     """
+    # Imported on first use to keep startup fast
+    import requests
+    from bs4 import BeautifulSoup
+
     headers = {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
     }
     
     try:
-        response = requests.get(url, headers=headers, timeout=30)
+        with host_controller.slot(url) as slot:
+            response = requests.get(url, headers=headers, stream=True, timeout=30)
+            slot.record(response.status_code, response.headers.get("Retry-After"))
+            html = response.text
         if response.status_code != 200:
             return None, f"Failed to fetch the page. Status code: {response.status_code}"
 
-        soup = BeautifulSoup(response.text, "html.parser")
+        soup = BeautifulSoup(html, "html.parser")
         
         # First look for comic images specifically
         comic_images = soup.select(".comic-content img")
@@ -66,62 +82,121 @@ def scrape_images(url):
         logger.error(f"Unexpected error in scrape_images: {e}")
         return None, f"Error: {str(e)}"
 
-def download_image(url, folder, index):
+def _save_response(response, url, folder, index):
     """
-    Downloads an image from a URL and saves it to the specified folder.
+    Writes a streamed image response to disk.
+
+    Args:
+        response (requests.Response): The streamed response.
+        url (str): The URL the response came from.
+        folder (str): The folder to save the image to.
+        index (int): The index number for the filename.
+
+    Returns:
+        str: The path to the saved image file or None if the response failed.
+    """
+    if response.status_code != 200:
+        logger.error(f"Failed to download image {url}. Status code: {response.status_code}")
+        return None
+        
+    # Determine the file extension
+    content_type = response.headers.get('Content-Type', '')
+    if 'image/jpeg' in content_type or 'image/jpg' in content_type:
+        ext = '.jpg'
+    elif 'image/png' in content_type:
+        ext = '.png'
+    elif 'image/gif' in content_type:
+        ext = '.gif'
+    else:
+        # Try to get extension from URL if content-type is not helpful
+        if '.png' in url.lower():
+            ext = '.png'
+        elif '.gif' in url.lower():
+            ext = '.gif'
+        else:
+            ext = '.jpg'  # Default to jpg
+            
+    # Create the output filename
+    filename = os.path.join(folder, f"{index}{ext}")
+    
+    # Save the image
+    with open(filename, 'wb') as file:
+        for chunk in response.iter_content(chunk_size=8192):
+            if chunk:
+                file.write(chunk)
+                
+    return filename
+
+def _fetch_image(slot, url, folder, index, last_attempt):
+    """
+    Downloads one image using an already granted host slot.
 
     Args:
+        slot (RequestSlot): The slot from the host controller.
         url (str): The URL of the image to download.
         folder (str): The folder to save the image to.
         index (int): The index number for the filename.
+        last_attempt (bool): Whether a throttled response should be given up on.
 
     Returns:
-        str: The path to the downloaded image file or None if failed.
+        tuple: The path to the downloaded image (or None) and whether to retry.
     """
+    import requests
+
     headers = {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
     }
     
     try:
-        response = requests.get(url, headers=headers, stream=True, timeout=30)
-        if response.status_code != 200:
-            logger.error(f"Failed to download image {url}. Status code: {response.status_code}")
-            return None
-            
-        # Determine the file extension
-        content_type = response.headers.get('Content-Type', '')
-        if 'image/jpeg' in content_type or 'image/jpg' in content_type:
-            ext = '.jpg'
-        elif 'image/png' in content_type:
-            ext = '.png'
-        elif 'image/gif' in content_type:
-            ext = '.gif'
-        else:
-            # Try to get extension from URL if content-type is not helpful
-            if '.png' in url.lower():
-                ext = '.png'
-            elif '.gif' in url.lower():
-                ext = '.gif'
-            else:
-                ext = '.jpg'  # Default to jpg
-                
-        # Create the output filename
-        filename = os.path.join(folder, f"{index}{ext}")
-        
-        # Save the image
-        with open(filename, 'wb') as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    file.write(chunk)
-                    
-        return filename
+        with slot:
+            response = requests.get(url, headers=headers, stream=True, timeout=30)
+            slot.record(response.status_code, response.headers.get("Retry-After"))
+            if response.status_code in THROTTLE_STATUSES and not last_attempt:
+                logger.warning(f"Host throttled {url} (status {response.status_code}), retrying")
+                response.close()
+                return None, True
+            return _save_response(response, url, folder, index), False
         
     except requests.RequestException as e:
         logger.error(f"Request error downloading {url}: {e}")
-        return None
+        return None, False
     except Exception as e:
         logger.error(f"Unexpected error downloading {url}: {e}")
-        return None
+        return None, False
+
+def download_image(url, folder, index):
+    """
+    Downloads an image from a URL and saves it to the specified folder.
+
+    Args:
+        url (str): The URL of the image to download.
+        folder (str): The folder to save the image to.
+        index (int): The index number for the filename.
+
+    Returns:
+        str: The path to the downloaded image file or None if failed.
+    """
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        path, retry = _fetch_image(host_controller.slot(url), url, folder, index, attempt == MAX_ATTEMPTS)
+        if not retry:
+            return path
+
+async def _download_image_async(url, folder, index):
+    """Like download_image, but waits for the host slot without holding a thread."""
+    loop = asyncio.get_running_loop()
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        slot = await host_controller.async_slot(url)
+        try:
+            path, retry = await loop.run_in_executor(
+                _download_executor, _fetch_image, slot, url, folder, index, attempt == MAX_ATTEMPTS
+            )
+        except asyncio.CancelledError:
+            # Cancelled before a thread picked it up, so nothing will release the slot
+            if not slot.entered:
+                slot.release()
+            raise
+        if not retry:
+            return path
 
 async def download_images(image_urls, folder):
     """
@@ -136,15 +211,11 @@ async def download_images(image_urls, folder):
     """
     os.makedirs(folder, exist_ok=True)
     
-    downloaded_paths = []
-    for idx, url in enumerate(image_urls, start=1):
-        # We're using a synchronous download function but handling them 
-        # concurrently would require more complex setup
-        path = download_image(url, folder, idx)
-        if path:
-            downloaded_paths.append(path)
-        
-        # Small delay to avoid overloading the server
-        await asyncio.sleep(0.5)
-        
-    return downloaded_paths
+    # The host controller decides how many downloads hit each host at once
+    # and how far apart they are spaced
+    results = await asyncio.gather(*[
+        _download_image_async(url, folder, idx)
+        for idx, url in enumerate(image_urls, start=1)
+    ])
+    
+    return [path for path in results if path]
@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+"""
+Job queue module.
+Durable SQLite-backed queue shared by the bot front end and worker processes.
+
+The front end enqueues jobs; workers claim them under a lease and post the
+messages they want delivered as events, which the front end sends to Telegram.
+A job whose worker dies is handed out again once its lease expires.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# How long a claimed job stays with a worker without a heartbeat
+LEASE_SECONDS = 60.0
+MAX_ATTEMPTS = 3
+# Metrics from workers that haven't reported for this long are left out
+METRICS_MAX_AGE = 300.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    worker TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_until REAL,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    delivered INTEGER NOT NULL DEFAULT 0,  -- 0 pending, 1 delivered, 2 given up on
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_pending ON events (delivered, id);
+CREATE TABLE IF NOT EXISTS worker_metrics (
+    worker TEXT PRIMARY KEY,
+    payload TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+class JobQueue:
+    """
+    Queue of jobs and outgoing events stored in a SQLite database.
+
+    Every call opens its own connection, so one instance can be shared
+    between threads and any number of processes can use the same file.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.getenv("JOB_DB", "jobs.db")
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def enqueue(self, kind, chat_id, payload):
+        """
+        Adds a job to the queue.
+
+        Args:
+            kind (str): The pipeline that should run the job.
+            chat_id (int): The chat the job reports to.
+            payload (dict): Pipeline arguments.
+
+        Returns:
+            int: The new job ID.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "INSERT INTO jobs (kind, chat_id, payload, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (kind, chat_id, json.dumps(payload), now, now)
+            )
+            job_id = cursor.lastrowid
+        logger.info(f"Queued {kind} job {job_id} for chat {chat_id}")
+        return job_id
+
+    def position(self, job_id):
+        """
+        Returns how many queued jobs are ahead of a job, including itself.
+
+        Args:
+            job_id (int): The job ID.
+
+        Returns:
+            int: The job's position in the queue.
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND id <= ?", (job_id,)
+            ).fetchone()
+        return row[0]
+
+    def claim(self, worker, lease=LEASE_SECONDS):
+        """
+        Takes the oldest queued job, requeueing jobs whose lease expired first.
+
+        Args:
+            worker (str): Name of the claiming worker.
+            lease (float): Seconds the worker holds the job without a heartbeat.
+
+        Returns:
+            dict: The claimed job with its payload decoded, or None if the queue is empty.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._requeue(conn, "status = 'running' AND lease_until < ?", (now,), now)
+                row = conn.execute(
+                    "SELECT * FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1"
+                ).fetchone()
+                if row is not None:
+                    conn.execute(
+                        "UPDATE jobs SET status = 'running', worker = ?, attempts = attempts + 1, "
+                        "lease_until = ?, updated_at = ? WHERE id = ?",
+                        (worker, now + lease, now, row["id"])
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+        if row is None:
+            return None
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        job["attempts"] += 1
+        return job
+
+    def heartbeat(self, job_id, worker, lease=LEASE_SECONDS):
+        """
+        Extends the lease on a running job.
+
+        Args:
+            job_id (int): The job ID.
+            worker (str): Name of the worker holding the job.
+            lease (float): Seconds to extend the lease by.
+
+        Returns:
+            bool: False if the job is no longer held by this worker.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_until = ?, updated_at = ? "
+                "WHERE id = ? AND worker = ? AND status = 'running'",
+                (now + lease, now, job_id, worker)
+            )
+        return cursor.rowcount == 1
+
+    def complete(self, job_id, worker):
+        """
+        Marks a job as done.
+
+        Returns:
+            bool: False if the job is no longer held by this worker.
+        """
+        return self._finish(job_id, worker, "done", None)
+
+    def fail(self, job_id, worker, error):
+        """
+        Marks a job as failed with the given error message.
+
+        Returns:
+            bool: False if the job is no longer held by this worker.
+        """
+        return self._finish(job_id, worker, "failed", error)
+
+    def release_worker(self, worker, count_attempt=True):
+        """
+        Puts jobs held by a worker back in the queue.
+
+        Called when a worker stops or restarts so its jobs don't wait for
+        the lease to expire.
+
+        Args:
+            worker (str): Name of the worker.
+            count_attempt (bool): False when the worker is stopping cleanly, so
+                the interrupted run doesn't count towards MAX_ATTEMPTS. Jobs
+                found after a crash still count.
+
+        Returns:
+            int: Number of jobs returned to the queue.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            if count_attempt:
+                return self._requeue(conn, "status = 'running' AND worker = ?", (worker,), now)
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'queued', worker = NULL, lease_until = NULL, "
+                "attempts = MAX(attempts - 1, 0), updated_at = ? "
+                "WHERE status = 'running' AND worker = ?",
+                (now, worker)
+            )
+            return cursor.rowcount
+
+    def post_event(self, job_id, chat_id, event):
+        """
+        Stores a message for the front end to deliver.
+
+        Args:
+            job_id (int): The job the event belongs to.
+            chat_id (int): The chat to deliver to.
+            event (dict): The message, with a "type" of text, document or photo.
+        """
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO events (job_id, chat_id, payload, created_at) VALUES (?, ?, ?, ?)",
+                (job_id, chat_id, json.dumps(event), time.time())
+            )
+
+    def event_keys(self, job_id):
+        """
+        Returns the keys of every event a job has posted so far.
+
+        Used when a job is retried, so messages from the interrupted attempt
+        aren't sent twice.
+
+        Args:
+            job_id (int): The job ID.
+
+        Returns:
+            set: The events' "key" values.
+        """
+        with self._connect() as conn:
+            rows = conn.execute("SELECT payload FROM events WHERE job_id = ?", (job_id,)).fetchall()
+        return {json.loads(row[0]).get("key") for row in rows} - {None}
+
+    def pending_events(self, after_id=0, limit=100):
+        """
+        Returns undelivered events in the order they were posted.
+
+        Args:
+            after_id (int): Only return events with a higher ID.
+            limit (int): Maximum number of events to return.
+
+        Returns:
+            list: Event dicts with id, job_id, chat_id and the decoded payload.
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT * FROM events WHERE delivered = 0 AND id > ? ORDER BY id LIMIT ?", (after_id, limit)
+            ).fetchall()
+        events = []
+        for row in rows:
+            event = dict(row)
+            event["payload"] = json.loads(event["payload"])
+            events.append(event)
+        return events
+
+    def mark_delivered(self, event_ids):
+        """Marks events as delivered."""
+        with self._connect() as conn:
+            conn.executemany("UPDATE events SET delivered = 1 WHERE id = ?", [(i,) for i in event_ids])
+
+    def drop_event(self, event_id):
+        """Marks an event that could not be delivered so it is no longer retried."""
+        with self._connect() as conn:
+            conn.execute("UPDATE events SET delivered = 2 WHERE id = ?", (event_id,))
+
+    def stats(self):
+        """
+        Counts jobs by status.
+
+        Returns:
+            dict: Mapping of status to number of jobs.
+        """
+        with self._connect() as conn:
+            rows = conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+    def save_metrics(self, worker, records):
+        """
+        Stores a worker's latest metrics, replacing what it saved before.
+
+        Args:
+            worker (str): Name of the worker.
+            records (list): The worker's metrics, as returned by metrics.export().
+        """
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO worker_metrics (worker, payload, updated_at) VALUES (?, ?, ?)",
+                (worker, json.dumps(records), time.time())
+            )
+
+    def worker_metrics(self, max_age=METRICS_MAX_AGE):
+        """
+        Returns the metrics saved by workers that reported recently.
+
+        Args:
+            max_age (float): Skip workers that haven't saved for this many seconds.
+
+        Returns:
+            list: [name, labels, value] records, each labelled with its worker.
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT worker, payload FROM worker_metrics WHERE updated_at >= ?", (time.time() - max_age,)
+            ).fetchall()
+        records = []
+        for worker, payload in rows:
+            for name, labels, value in json.loads(payload):
+                records.append([name, dict(labels, worker=worker), value])
+        return records
+
+    def _finish(self, job_id, worker, status, error):
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, lease_until = NULL, updated_at = ? "
+                "WHERE id = ? AND worker = ? AND status = 'running'",
+                (status, error, time.time(), job_id, worker)
+            )
+        return cursor.rowcount == 1
+
+    def _requeue(self, conn, where, params, now):
+        rows = conn.execute(f"SELECT id, chat_id, attempts FROM jobs WHERE {where}", params).fetchall()
+        for job_id, chat_id, attempts in rows:
+            if attempts >= MAX_ATTEMPTS:
+                logger.error(f"Job {job_id} failed after {attempts} attempts")
+                conn.execute(
+                    "UPDATE jobs SET status = 'failed', error = 'too many attempts', "
+                    "lease_until = NULL, updated_at = ? WHERE id = ?",
+                    (now, job_id)
+                )
+                conn.execute(
+                    "INSERT INTO events (job_id, chat_id, payload, created_at) VALUES (?, ?, ?, ?)",
+                    (job_id, chat_id, json.dumps({"type": "text", "text": "❌ Job failed, please try again."}), now)
+                )
+            else:
+                logger.warning(f"Requeueing job {job_id} (attempt {attempts} was interrupted)")
+                conn.execute(
+                    "UPDATE jobs SET status = 'queued', worker = NULL, lease_until = NULL, "
+                    "updated_at = ? WHERE id = ?",
+                    (now, job_id)
+                )
+        return len(rows)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Metrics module.
+Keeps simple in-process counters and gauges for the bot.
+"""
+
+import threading
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def increment(name, value=1, **labels):
+    """
+    Increments a counter.
+
+    Args:
+        name (str): The metric name.
+        value (float): The amount to add.
+        **labels: Label values identifying the series.
+    """
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def set_gauge(name, value, **labels):
+    """
+    Sets a gauge to the given value.
+
+    Args:
+        name (str): The metric name.
+        value (float): The current value.
+        **labels: Label values identifying the series.
+    """
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+def snapshot():
+    """
+    Returns a copy of all recorded metrics.
+
+    Returns:
+        dict: Mapping of (name, labels) tuples to their current values.
+    """
+    with _lock:
+        data = dict(_counters)
+        data.update(_gauges)
+    return data
+
+def export():
+    """
+    Returns all recorded metrics in a JSON-friendly form, for sharing
+    them with another process.
+
+    Returns:
+        list: [name, labels, value] records, with labels as a dict.
+    """
+    return [[name, dict(labels), value] for (name, labels), value in snapshot().items()]
+
+def format_metrics(records=()):
+    """
+    Formats all recorded metrics as text, one series per line.
+
+    Args:
+        records (iterable): Extra [name, labels, value] records to include,
+            as returned by export() in another process.
+
+    Returns:
+        str: The formatted metrics, or an empty string if none were recorded.
+    """
+    data = snapshot()
+    for name, labels, value in records:
+        data[_key(name, labels)] = value
+    lines = []
+    for (name, labels), value in sorted(data.items()):
+        if labels:
+            label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+            name = f"{name}{{{label_text}}}"
+        if isinstance(value, float):
+            value = round(value, 3)
+        lines.append(f"{name} {value}")
+    return "\n".join(lines)
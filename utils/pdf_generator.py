@@ -6,7 +6,6 @@ Creates PDFs from a collection of images.
 
 import os
 import logging
-from PIL import Image
 
 logger = logging.getLogger(__name__)
 
@@ -24,6 +23,9 @@ def create_pdf_from_images(folder_path, output_pdf_path):
     Raises:
         Exception: If no valid images are found in the folder.
     """
+    # Imported on first use to keep startup fast
+    from PIL import Image
+
     try:
         # Get all image files in the folder and sort them numerically
         image_files = []
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Job worker for the Anime & Multporn Telegram Bot.
+Runs the multporn and anime pipelines for jobs queued by the bot front end.
+
+Usage: python worker.py <name>
+"""
+
+import os
+import sys
+import uuid
+import shutil
+import signal
+import asyncio
+import logging
+from types import SimpleNamespace
+
+from merged_bot import process_anime_request, process_multporn_download
+from utils import metrics
+from utils.job_queue import JobQueue, LEASE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Folder holding files waiting for the front end to upload them
+OUTBOX_FOLDER = os.getenv("OUTBOX_FOLDER", "outbox")
+
+POLL_INTERVAL = 1.0
+# How often the worker's metrics are saved for the bot's /metrics command
+METRICS_INTERVAL = LEASE_SECONDS / 3
+
+class JobReporter:
+    """
+    Stands in for the Pyrogram client and message inside a job.
+
+    Everything the pipelines would send to Telegram is posted to the job
+    queue instead, for the front end to deliver. Each event gets a key, and
+    events whose key an earlier attempt already posted are skipped.
+    """
+
+    def __init__(self, job_queue, job_id, chat_id, sent_keys=()):
+        self.job_queue = job_queue
+        self.job_id = job_id
+        self.chat = SimpleNamespace(id=chat_id)
+        self.sent_keys = set(sent_keys)
+        self.key_counts = {}
+
+    def _key(self, base):
+        # Numbered so the same message sent twice in one run keeps both
+        self.key_counts[base] = self.key_counts.get(base, 0) + 1
+        return f"{base}#{self.key_counts[base]}"
+
+    async def _post(self, event):
+        await asyncio.to_thread(self.job_queue.post_event, self.job_id, self.chat.id, event)
+
+    async def reply_text(self, text, parse_mode=None, **kwargs):
+        key = self._key(f"text:{text}")
+        if key in self.sent_keys:
+            return
+        await self._post({
+            "type": "text",
+            "text": text,
+            "parse_mode": parse_mode.name if parse_mode else None,
+            "key": key
+        })
+
+    async def send_document(self, chat_id, document, file_name=None, **kwargs):
+        # Downloads are named by their index in the gallery, so this matches across attempts
+        key = self._key(f"document:{os.path.basename(document)}:{file_name}")
+        if key in self.sent_keys:
+            return
+        # The pipeline deletes its temp folder when done, so keep our own copy
+        folder = os.path.join(OUTBOX_FOLDER, str(self.job_id))
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(os.path.abspath(folder), f"{uuid.uuid4().hex}{os.path.splitext(document)[1]}")
+        try:
+            os.link(document, path)
+        except OSError:
+            shutil.copyfile(document, path)
+        await self._post({"type": "document", "path": path, "file_name": file_name, "key": key})
+
+    async def send_photo(self, chat_id, photo, caption=None, parse_mode=None, **kwargs):
+        key = self._key(f"photo:{photo}")
+        if key in self.sent_keys:
+            return
+        await self._post({
+            "type": "photo",
+            "photo": photo,
+            "caption": caption,
+            "parse_mode": parse_mode.name if parse_mode else None,
+            "key": key
+        })
+
+async def run_job(job_queue, job):
+    """Run a claimed job through its pipeline."""
+    # Non-empty when an earlier run of this job was interrupted
+    sent_keys = await asyncio.to_thread(job_queue.event_keys, job["id"])
+    if sent_keys:
+        await asyncio.to_thread(job_queue.post_event, job["id"], job["chat_id"], {
+            "type": "text",
+            "text": "🔁 Resuming after an interruption. Anything already sent won't be sent again."
+        })
+    reporter = JobReporter(job_queue, job["id"], job["chat_id"], sent_keys)
+    payload = job["payload"]
+
+    if job["kind"] == "multporn":
+        await process_multporn_download(reporter, reporter, payload["url"], payload["limit"])
+    elif job["kind"] == "anime":
+        await process_anime_request(
+            reporter, reporter, payload["anime_name"], payload["format_type"], payload["quality"]
+        )
+    else:
+        raise ValueError(f"Unknown job kind: {job['kind']}")
+
+async def keep_lease(job_queue, job_id, name):
+    """Renew the job's lease until cancelled. Returns if the lease is lost."""
+    while True:
+        await asyncio.sleep(LEASE_SECONDS / 3)
+        if not await asyncio.to_thread(job_queue.heartbeat, job_id, name):
+            logger.warning(f"{name} lost the lease on job {job_id}")
+            return
+
+async def report_metrics(job_queue, name):
+    """Save this worker's metrics to the job queue until cancelled."""
+    while True:
+        try:
+            await asyncio.to_thread(job_queue.save_metrics, name, metrics.export())
+        except Exception as e:
+            logger.error(f"{name} could not save its metrics: {e}")
+        await asyncio.sleep(METRICS_INTERVAL)
+
+async def work(name):
+    """Claim and run jobs until stopped."""
+    job_queue = JobQueue()
+
+    # Anything this worker held before a restart goes back in the queue
+    released = await asyncio.to_thread(job_queue.release_worker, name)
+    if released:
+        logger.info(f"{name} returned {released} unfinished jobs to the queue")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    metrics_task = asyncio.create_task(report_metrics(job_queue, name))
+    logger.info(f"{name} waiting for jobs")
+    while not stop.is_set():
+        job = await asyncio.to_thread(job_queue.claim, name)
+        if job is None:
+            try:
+                await asyncio.wait_for(stop.wait(), POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        logger.info(f"{name} running {job['kind']} job {job['id']} (attempt {job['attempts']})")
+        job_task = asyncio.create_task(run_job(job_queue, job))
+        lease_task = asyncio.create_task(keep_lease(job_queue, job["id"], name))
+        stop_task = asyncio.create_task(stop.wait())
+        await asyncio.wait([job_task, stop_task, lease_task], return_when=asyncio.FIRST_COMPLETED)
+        lease_task.cancel()
+        stop_task.cancel()
+
+        if not job_task.done():
+            job_task.cancel()
+            # Let the job unwind (and clean up its temp files) before moving on
+            try:
+                await job_task
+            except asyncio.CancelledError:
+                pass
+            except Exception as e:
+                logger.error(f"{name} job {job['id']} failed while being cancelled: {e}")
+            if stop.is_set():
+                # Stopped mid-job: hand it back so another worker picks it up
+                await asyncio.to_thread(job_queue.release_worker, name, False)
+                break
+            # Lease lost: another worker may already be running this job
+            logger.warning(f"{name} abandoned job {job['id']}")
+            continue
+
+        error = job_task.exception()
+        if error:
+            logger.error(f"{name} failed job {job['id']}: {error}")
+            if await asyncio.to_thread(job_queue.fail, job["id"], name, str(error)):
+                await asyncio.to_thread(
+                    job_queue.post_event, job["id"], job["chat_id"], {"type": "text", "text": f"❌ Error: {error}"}
+                )
+        elif await asyncio.to_thread(job_queue.complete, job["id"], name):
+            logger.info(f"{name} finished job {job['id']}")
+        else:
+            logger.warning(f"{name} finished job {job['id']} after losing its lease")
+
+    metrics_task.cancel()
+    await asyncio.to_thread(job_queue.save_metrics, name, metrics.export())
+    logger.info(f"{name} stopped")
+
+if __name__ == "__main__":
+    asyncio.run(work(sys.argv[1] if len(sys.argv) > 1 else f"worker-{os.getpid()}"))